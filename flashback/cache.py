@@ -0,0 +1,120 @@
+# Copyright (C) 2015 zulily, llc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""flashback archive metadata cache"""
+
+import json
+import os
+import tempfile
+
+from flashback.tasks import get_archive_data
+
+
+def parse_archive_output(output):
+    """Split output from find_archived_files into a list of (archive
+    directory, generation, archived file paths).  Paths are empty when
+    the find was skipped for an unchanged generation.
+    """
+    entries = list()
+    for line in (output or '').splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'generation':
+            entries.append((fields[1], fields[2], list()))
+        elif fields and entries:
+            entries[-1][2].extend(fields)
+    return entries
+
+
+class ArchiveCache(object):
+    """Archive metadata for each host, kept on the control node.  For each
+    host and archive directory, the cache holds the directory's generation
+    and the files archived under each date.  Only hosts whose generation
+    has changed need to list their archives again.  With no path, the
+    cache is kept in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hosts = dict()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as cache_file:
+                    self.hosts = json.load(cache_file)
+            except ValueError:
+                # A corrupt cache is rebuilt from scratch
+                self.hosts = dict()
+
+    def generations(self):
+        """Cached generations as host -> archive directory -> generation"""
+        return dict((host, dict((directory, entry['generation'])
+                                for directory, entry in directories.items()))
+                    for host, directories in self.hosts.items())
+
+    def update(self, output):
+        """Update the cache from per-host find_archived_files output.
+        Hosts with no output, such as those that failed, are left as is.
+        """
+        for host, host_output in output.items():
+            if not host_output:
+                continue
+            directories = self.hosts.setdefault(host, dict())
+            for directory, generation, paths in \
+            parse_archive_output(host_output):
+                entry = directories.get(directory)
+                if entry and entry['generation'] == generation:
+                    continue
+                dates = get_archive_data({host: '\n'.join(paths)})[host]
+                directories[directory] = dict(generation=generation,
+                                              dates=dates)
+
+    def archive_data(self, hosts, archive_directories):
+        """Archive data in the form returned by get_archive_data, for
+        hosts, merged across each host's archive directories
+        (host -> list of directories).
+        """
+        archive_data = dict()
+        for host in hosts:
+            dates = archive_data.setdefault(host, dict())
+            for directory in archive_directories.get(host, list()):
+                entry = self.hosts.get(host, dict()).get(directory)
+                for date, files in (entry['dates'] if entry else dict()).\
+                items():
+                    merged = dates.setdefault(date, list())
+                    merged.extend(f for f in files if f not in merged)
+        return archive_data
+
+    def latest_dates(self, archive_directory, hosts):
+        """The most recent archive date of each file under
+        archive_directory, as host -> file name -> date.  Only the given
+        hosts are included, such as those whose cache was just revalidated.
+        """
+        latest = dict()
+        for host in hosts:
+            files = latest.setdefault(host, dict())
+            entry = self.hosts.get(host, dict()).get(archive_directory)
+            if not entry:
+                continue
+            for date in sorted(entry['dates']):
+                for system_file in entry['dates'][date]:
+                    files[system_file] = int(date)
+        return latest
+
+    def save(self):
+        """Write the cache, replacing any previous copy atomically"""
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as cache_file:
+            json.dump(self.hosts, cache_file)
+        os.rename(temp_path, self.path)
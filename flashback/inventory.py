@@ -0,0 +1,129 @@
+# Copyright (C) 2015 zulily, llc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""flashback inventory"""
+
+import functools
+import os
+import re
+
+from collections import namedtuple, OrderedDict
+from fabric.api import env
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+# A group of hosts sharing the same system files, size limits (full
+# path -> bytes), archive directory and post-recover command
+Group = namedtuple('Group', ['name', 'hosts', 'system_files', 'size_limits',
+                             'archive_directory', 'post_recover_command'])
+
+
+def read_hosts(hosts_file):
+    """
+    Read in list of hosts.
+    """
+    with open(hosts_file, 'r') as hosts_file:
+        return [hv.rstrip('\n') for hv in hosts_file if len(hv.rstrip('\n')) > 0]
+
+
+def _split(value):
+    """Split a comma and/or whitespace separated setting into a list"""
+    return [item for item in re.split(r'[,\s]+', value or '') if item]
+
+
+def read_inventory(inventory_file, parse_system_file, system_file_specs,
+                   archive_directory, post_recover_command):
+    """Read an INI inventory, with one section per group of hosts:
+
+        [web]
+        hosts = web1.example.com, web2.example.com
+        hosts_file = more_web_hosts.txt
+        system_files = /etc/nginx/nginx.conf /etc/ssl/bundle.pem:200M
+        archive_directory = /root/.flashback
+        post_recover_command = service nginx reload
+
+    Settings missing from a section (and its [DEFAULT] section) fall back
+    to the system_file_specs, archive_directory and post_recover_command
+    arguments.  system_files, and the FULLPATH[:SIZE] specs falling back
+    to system_file_specs, are split into a full path and size limit by
+    parse_system_file.  hosts_file is relative to the inventory file.
+    Raises ValueError if the inventory is missing or a group has no hosts.
+    """
+    parser = RawConfigParser()
+    if not parser.read(inventory_file):
+        raise ValueError('Unable to read inventory {0}'.format(inventory_file))
+    base_directory = os.path.dirname(os.path.abspath(inventory_file))
+    groups = list()
+    for name in parser.sections():
+        settings = dict(parser.items(name))
+        hosts = _split(settings.get('hosts'))
+        if settings.get('hosts_file'):
+            hosts.extend(read_hosts(os.path.join(base_directory,
+                                                 settings['hosts_file'])))
+        if not hosts:
+            raise ValueError('No hosts for inventory group {0}'.format(name))
+        group_files = list()
+        size_limits = dict()
+        for spec in _split(settings.get('system_files')) or \
+        system_file_specs:
+            full_path, size_limit = parse_system_file(spec)
+            group_files.append(full_path)
+            size_limits[full_path] = size_limit
+        groups.append(Group(name, hosts, group_files, size_limits,
+                            settings.get('archive_directory',
+                                         archive_directory),
+                            settings.get('post_recover_command',
+                                         post_recover_command)))
+    return groups
+
+
+def inventory_hosts(groups):
+    """All hosts across groups, in order, without duplicates"""
+    return list(OrderedDict((host, None) for group in groups
+                            for host in group.hosts))
+
+
+def group_arguments(groups, build):
+    """Build a dict of host -> list of task argument tuples, one per group
+    the host belongs to.  build is called with each group and returns the
+    task arguments for it, or None to skip the group.  Identical arguments
+    from several groups are only run once per host.
+    """
+    arguments = OrderedDict()
+    for group in groups:
+        group_args = build(group)
+        if group_args is None:
+            continue
+        for host in group.hosts:
+            host_args = arguments.setdefault(host, list())
+            if group_args not in host_args:
+                host_args.append(group_args)
+    return arguments
+
+
+def grouped(task, arguments):
+    """Wrap a fabric task so each host runs it once for every group it
+    belongs to, over the same connection.  arguments is the dict built by
+    group_arguments.  Results that are strings, such as find output, are
+    joined together.
+    """
+    @functools.wraps(task)
+    def run_groups():
+        results = [task(*task_args)
+                   for task_args in arguments.get(env.host_string, list())]
+        results = [result for result in results if result]
+        return '\n'.join(results) if results else None
+    return run_groups
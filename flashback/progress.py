@@ -0,0 +1,221 @@
+# Copyright (C) 2015 zulily, llc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""flashback progress"""
+from __future__ import print_function
+
+import functools
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from fabric.api import env
+from fabric.colors import red
+from fabric.exceptions import NetworkError
+
+# Seconds between redraws of the live progress line
+REFRESH_INTERVAL = 1.0
+# Number of in-flight hosts listed as the slowest
+SLOWEST_HOSTS = 3
+
+
+def format_duration(seconds):
+    """Format seconds as a short duration, such as 1h02m or 3m40s"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{0}h{1:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{0}m{1:02d}s'.format(seconds // 60, seconds % 60)
+    return '{0}s'.format(seconds)
+
+
+class Progress(object):
+    """Track per-host completion of fabric tasks.  Tasks wrapped with track
+    report start and completion events over a multiprocessing queue, so
+    events from forked fabric workers and shard processes all arrive here.
+    A listener thread turns them into a live status line on stderr, an
+    optional stream of JSON lines for wrapping tools, and prints any
+    buffered per-host output in one piece.
+    """
+
+    def __init__(self, total, display=False, stream=None,
+                 buffer_output=False):
+        self.total = total
+        self.display = display
+        self.stream = stream
+        self.buffer_output = buffer_output
+        self.done = 0
+        self.failed = 0
+        self.failed_hosts = list()
+        self.in_flight = dict()
+        self.started = None
+        self._queue = multiprocessing.Queue()
+        self._thread = None
+        self._line_length = 0
+
+    def track(self, task):
+        """Wrap a fabric task so each host reports its start, completion
+        and captured output back to this Progress.  A host that aborts,
+        such as one that is unreachable, is reported as failed with a
+        result of None, rather than aborting every other host's task.
+        """
+        @functools.wraps(task)
+        def tracked(*args, **kwargs):
+            host = env.host_string
+            self._queue.put(('start', task.__name__, host, time.time(), None))
+            stdout = sys.stdout
+            if self.buffer_output:
+                sys.stdout = StringIO()
+            # Tasks set flashback_error when they report an error
+            # without raising
+            env.flashback_error = False
+            status = 'failed'
+            try:
+                result = task(*args, **kwargs)
+                if not env.flashback_error:
+                    status = 'done'
+                return result
+            except (SystemExit, NetworkError) as error:
+                print(red('[{0}] Error running {1}: {2}'.\
+                          format(host, task.__name__, error)))
+                return None
+            finally:
+                output = None
+                if self.buffer_output:
+                    output = sys.stdout.getvalue()
+                    sys.stdout = stdout
+                self._queue.put((status, task.__name__, host, time.time(),
+                                 output))
+        return tracked
+
+    def start(self):
+        """Start listening for events from tracked tasks"""
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Process any remaining events and write a final summary"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._emit('summary')
+        if self.display:
+            self._render()
+            sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    def rate(self):
+        """Completed hosts per second since start"""
+        elapsed = time.time() - self.started
+        return (self.done + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def pending(self):
+        """Hosts not yet completed, including those in flight"""
+        return max(self.total - self.done - self.failed, 0)
+
+    def slowest(self):
+        """In-flight hosts that have been running longest, with elapsed
+        seconds
+        """
+        now = time.time()
+        return sorted(((host, now - started) for (_, host), started
+                       in self.in_flight.items()),
+                      key=lambda item: item[1], reverse=True)[:SLOWEST_HOSTS]
+
+    def _listen(self):
+        """Consume events until stop is called, redrawing the status line
+        at least every REFRESH_INTERVAL seconds.
+        """
+        while True:
+            try:
+                event = self._queue.get(timeout=REFRESH_INTERVAL)
+            except Empty:
+                event = False
+            if event is None:
+                return
+            if event:
+                self._handle(*event)
+            if self.display:
+                self._render()
+
+    def _handle(self, status, task, host, timestamp, output):
+        """Update counters for a single event"""
+        key = (task, host)
+        elapsed = None
+        if status == 'start':
+            self.in_flight[key] = timestamp
+        else:
+            started = self.in_flight.pop(key, timestamp)
+            elapsed = timestamp - started
+            if status == 'done':
+                self.done += 1
+            else:
+                self.failed += 1
+                if host not in self.failed_hosts:
+                    self.failed_hosts.append(host)
+        if output:
+            self._clear()
+            sys.stdout.write(output)
+            sys.stdout.flush()
+        self._emit(status, task=task, host=host, elapsed=elapsed)
+
+    def _emit(self, event, **fields):
+        """Write a JSON line describing an event to the progress stream"""
+        if self.stream is None:
+            return
+        record = dict(event=event, time=time.time(), total=self.total,
+                      done=self.done, failed=self.failed,
+                      pending=self.pending(), rate=round(self.rate(), 2))
+        record.update((k, v) for k, v in fields.items() if v is not None)
+        self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+        self.stream.flush()
+
+    def _clear(self):
+        """Erase the status line so other output starts on a clean line"""
+        if self.display and self._line_length:
+            sys.stderr.write('\r' + ' ' * self._line_length + '\r')
+            sys.stderr.flush()
+            self._line_length = 0
+
+    def _render(self):
+        """Redraw the status line on stderr"""
+        rate = self.rate()
+        eta = format_duration(self.pending() / rate) if rate > 0 else '?'
+        line = '{0}/{1} done, {2} failed, {3} pending | {4:.1f} hosts/s | ' \
+               'ETA {5}'.format(self.done, self.total, self.failed,
+                                self.pending(), rate, eta)
+        slowest = self.slowest()
+        if slowest:
+            line += ' | slowest: ' + ', '.join('{0} ({1})'.\
+                    format(host, format_duration(elapsed))
+                    for host, elapsed in slowest)
+        self._clear()
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        self._line_length = len(line)
@@ -23,22 +23,39 @@ from __future__ import print_function
 
 import argparse
 import getpass
+import re
 import sys
-from os.path import basename
+from os.path import basename, expanduser
 from fabric.api import env, hide
-from fabric.colors import yellow
-from fabric.tasks import execute
+from fabric.colors import red, yellow
 from fabric.network import disconnect_all
+from flashback.cache import ArchiveCache
+from flashback.inventory import Group, group_arguments, grouped, \
+                                inventory_hosts, read_hosts, read_inventory
+from flashback.progress import Progress
+from flashback.shard import execute_sharded, merge_shard_outputs, \
+                            shard_hosts, write_shard_output
 from flashback.tasks import archive_files, diff_files, find_archived_files, generate_report, \
-                            get_archive_data, post_recover_command, purge, recover_files
+                            post_recover_command, purge, recover_files
 
 
 # Sensitive files such as /etc/shadow must be properly protected
 # under the archive directory
 ARCHIVE_DIRECTORY = '/root/.flashback'
+# Archive metadata cached on the control node, for report and
+# resolving --date-first/--recover-date latest
+CACHE_FILE = '~/.flashback_cache.json'
 DEFAULT_WORKERS = 10
-# SYSTEM_FILES should only contain *smallish* files such as
-# these defaults
+DEFAULT_SHARDS = 1
+# Files larger than this are skipped by archive.  May be
+# overridden per file.
+DEFAULT_MAX_FILE_SIZE = '256M'
+# Files larger than this are compared by checksum rather than
+# diffed, keeping diff output small on the control node
+DEFAULT_MAX_DIFF_SIZE = '4M'
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# SYSTEM_FILES defaults to *smallish* files, larger files and
+# binary files are supported within the size limit
 SYSTEM_FILES = ['/etc/passwd', '/etc/shadow', '/etc/group', '/etc/gshadow']
 
 
@@ -46,64 +63,213 @@ def main():
     """Do some stuff..."""
     args = parse_arguments().parse_args()
 
+    # Merging reports saved by several control nodes needs no hosts
+    if args.subcommand == 'merge':
+        print(generate_report(merge_shard_outputs(args.shard_outputs)))
+        return 0
+
     # Set a sudo password if requested
     password = None
     if args.sudo_password_prompt:
         password = getpass.getpass(prompt='sudo Password: ')
         env.password = password
 
-    system_files = args.system_files if args.system_files else SYSTEM_FILES
-    system_files_map = dict()
-    for full_path in system_files:
-        if len(full_path.split('/')) > 1:
-            system_files_map[basename(full_path)] = full_path
-    hosts = args.hosts if args.hosts \
-        else read_hosts(args.hosts_file)
+    parse_file = lambda spec: parse_system_file(spec, args.max_file_size)
+    system_file_specs = args.system_files if args.system_files \
+        else SYSTEM_FILES
+    system_files = list()
+    size_limits = dict()
+    for spec in system_file_specs:
+        full_path, size_limit = parse_file(spec)
+        system_files.append(full_path)
+        size_limits[full_path] = size_limit
+    command = getattr(args, 'post_recover_command', None)
+    # Every host belongs to one or more groups, each with its own
+    # system files, archive directory and post-recover command
+    if args.inventory:
+        try:
+            groups = read_inventory(args.inventory, parse_file,
+                                    system_file_specs,
+                                    args.archive_directory, command)
+        except (IOError, ValueError) as error:
+            print(red(str(error)))
+            return 1
+    else:
+        hosts = args.hosts if args.hosts \
+            else read_hosts(args.hosts_file)
+        groups = [Group('all', hosts, system_files, size_limits,
+                        args.archive_directory, command)]
+    hosts = inventory_hosts(groups)
     # Configure parallelism, or if the environment
     # goes unchanged, tasks will run serialized
     if args.parallel_workers > 1:
         env.parallel = True
         env.pool_size = args.parallel_workers
+    if args.shard_index is not None and \
+    not 0 <= args.shard_index < args.shards:
+        print(red('--shard-index must be between 0 and {0}'.\
+                  format(args.shards - 1)))
+        return 1
+    # Split hosts across worker processes, or when --shard-index is given,
+    # keep only this node's slice of the fleet
+    shards = shard_hosts(hosts, args.shards)
+    if args.shard_index is not None:
+        shards = [shards[args.shard_index]]
     env.hosts = hosts
     if args.subcommand == 'purge':
+        archive_directories = ', '.join(sorted(set(group.archive_directory
+                                                   for group in groups)))
         proceed = raw_input('Are you absolutely sure you wish to purge ' + \
-            'this directory: {0}? (yes/no): '.format(args.archive_directory))
+            'this directory: {0}? (yes/no): '.format(archive_directories))
         if proceed != 'yes':
             print(yellow('{0}: Directory {1} was not removed.'.\
-                         format(env.host_string, args.archive_directory)))
+                         format(env.host_string, archive_directories)))
             return 1
     hide_output = 'everything' if not args.verbose else 'user'
+    # Resolving 'latest' archive dates first refreshes the cache, and
+    # recover with a post-recover command runs a second task
+    resolve_latest = 'latest' in (getattr(args, 'date_first', None),
+                                  getattr(args, 'recover_date', None))
+    post_recover = args.subcommand == 'recover' and \
+        any(group.post_recover_command for group in groups)
+    phases = 1 + resolve_latest + post_recover
+    cache = ArchiveCache(None if args.no_cache
+                         else expanduser(args.cache_file))
+    progress_stream = open(args.progress_stream, 'w') \
+        if args.progress_stream else None
+    # Parallel workers and shard processes buffer their output per
+    # host, so lines from different hosts are not interleaved
+    progress = Progress(sum(len(shard) for shard in shards) * phases,
+                        display=args.progress, stream=progress_stream,
+                        buffer_output=env.parallel or
+                        len([shard for shard in shards if shard]) > 1)
+
+    def run(task, build):
+        """Run task once per group on each host, with the arguments
+        build returns for that group, returning per-host results.
+        """
+        task = progress.track(grouped(task, group_arguments(groups, build)))
+        return execute_sharded(shards, task)
+
+    def refresh_cache():
+        """Revalidate cached archive metadata with a single check per host
+        and archive directory, only listing archives again where changed.
+        Returns per-host output, and the hosts that were checked.
+        """
+        generations = cache.generations()
+        output = run(find_archived_files,
+                     lambda group: (group.archive_directory, generations))
+        cache.update(output)
+        cache.save()
+        checked = [host for host in output if output[host]]
+        unchecked = [host for host in output if not output[host]]
+        if unchecked:
+            print(red('Unable to check archives on: {0}'.\
+                      format(', '.join(unchecked))))
+            failed_hosts = env.setdefault('flashback_failed_hosts', list())
+            failed_hosts.extend(host for host in unchecked
+                                if host not in failed_hosts)
+        return output, checked
+
+    progress.start()
     # fab tasks need to be called with execute, or env settings
-    # will not be used.
-    with hide(hide_output):
-        if args.subcommand == 'archive':
-            execute(archive_files, system_files, args.archive_directory)
-        elif args.subcommand == 'purge':
-            execute(purge, args.archive_directory)
-        elif args.subcommand == 'report':
-            output = execute(find_archived_files, args.archive_directory)
-            archive_data = get_archive_data(output)
-            print(generate_report(archive_data))
-        elif args.subcommand == 'diff':
-            execute(diff_files, system_files_map, args.date_first,
-                    args.date_second, args.archive_directory)
-        elif args.subcommand == 'recover':
-            execute(recover_files, system_files_map, args.recover_date,
-                    args.archive_directory, args.dry_run)
-            if args.post_recover_command:
-                execute(post_recover_command, args.post_recover_command,
-                        args.dry_run)
+    # will not be used.  execute_sharded calls execute once per shard.
+    try:
+        with hide(hide_output):
+            if args.subcommand == 'archive':
+                run(archive_files, lambda group: (group.system_files,
+                                                  group.archive_directory,
+                                                  group.size_limits))
+            elif args.subcommand == 'purge':
+                run(purge, lambda group: (group.archive_directory,))
+            elif args.subcommand == 'report':
+                output, checked = refresh_cache()
+                archive_directories = group_arguments(
+                    groups, lambda group: group.archive_directory)
+                # Hosts that could not be checked report no results,
+                # rather than stale cached data
+                archive_data = cache.archive_data(checked,
+                                                  archive_directories)
+                archive_data.update((host, dict()) for host in output
+                                    if not output[host])
+                progress.stop()
+                if args.shard_output:
+                    write_shard_output(args.shard_output, archive_data)
+                print(generate_report(archive_data))
+            elif args.subcommand == 'diff':
+                # Only hosts checked in this run resolve latest dates
+                checked = refresh_cache()[1] if resolve_latest else list()
+                run(diff_files, lambda group: (
+                    map_system_files(group.system_files), args.date_first,
+                    args.date_second, group.archive_directory,
+                    args.max_diff_size,
+                    cache.latest_dates(group.archive_directory, checked)))
+            elif args.subcommand == 'recover':
+                checked = refresh_cache()[1] if resolve_latest else list()
+                run(recover_files, lambda group: (
+                    map_system_files(group.system_files), args.recover_date,
+                    group.archive_directory, args.dry_run,
+                    cache.latest_dates(group.archive_directory, checked)))
+                if post_recover:
+                    run(post_recover_command, lambda group: (
+                        group.post_recover_command, args.dry_run)
+                        if group.post_recover_command else None)
+    finally:
+        progress.stop()
+        if progress_stream:
+            progress_stream.close()
     # Clean up any fabric connections still open.
     disconnect_all()
+    failed_hosts = list(env.get('flashback_failed_hosts', list()))
+    failed_hosts.extend(host for host in progress.failed_hosts
+                        if host not in failed_hosts)
+    if failed_hosts:
+        print(red('Failed hosts: {0}'.format(', '.join(failed_hosts))))
+    return 1 if failed_hosts or progress.failed else 0
 
 
+def map_system_files(system_files):
+    """
+    Map archived file names to the full path of each system file.
+    """
+    system_files_map = dict()
+    for full_path in system_files:
+        if len(full_path.split('/')) > 1:
+            system_files_map[basename(full_path)] = full_path
+    return system_files_map
+
+
+def parse_date(date):
+    """
+    Convert a YYYYMMDD date argument to an int, or keep 'latest'.
+    """
+    if date == 'latest':
+        return date
+    try:
+        return int(date)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid date: {0}'.format(date))
 
-def read_hosts(hosts_file):
+
+def parse_size(size):
+    """
+    Convert a size such as 512K, 200M or 1G into bytes, 0 for no limit.
+    """
+    match = re.match(r'^(\d+)([KMG]?)B?$', size.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: {0}'.format(size))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_system_file(spec, default_size_limit):
     """
-    Read in list of hosts.
+    Split a FULLPATH[:SIZE] system file argument into its full path
+    and size limit in bytes.
     """
-    with open(hosts_file, 'r') as hosts_file:
-        return [hv.rstrip('\n') for hv in hosts_file if len(hv.rstrip('\n')) > 0]
+    full_path, _, size = spec.rpartition(':')
+    if full_path and re.match(r'^\d+[KMGkmg]?[Bb]?$', size):
+        return full_path, parse_size(size)
+    return spec, default_size_limit
 
 
 def parse_arguments():
@@ -135,14 +301,36 @@ def parse_arguments():
                             dest='hosts_file', metavar='FILE',
                             help='Text file containing a list of hosts, ' + \
                             'one per line. Ignored if --host is specified')
+    host_group.add_argument('--inventory', '-I', action='store',
+                            dest='inventory', metavar='FILE',
+                            help='INI file with a section per group of ' + \
+                            'hosts, each with its own hosts, ' + \
+                            'hosts_file, system_files, ' + \
+                            'archive_directory and ' + \
+                            'post_recover_command settings.  All ' + \
+                            'groups are run together, settings a ' + \
+                            'group leaves out fall back to the ' + \
+                            'command-line arguments')
     parser_common.add_argument('--system-file', '-F', action='append',
-                               dest='system_files', metavar='FULLPATH',
+                               dest='system_files',
+                               metavar='FULLPATH[:SIZE]',
                                help='Full path for ' + \
-                               'system files to perform operations on. ' + \
+                               'system files to perform operations on, ' + \
+                               'optionally with an archive size limit ' + \
+                               'overriding --max-file-size, such as ' + \
+                               '/usr/share/GeoIP/GeoIP.dat:512M. ' + \
                                'Does not apply when used with the purge ' + \
                                'subcommand (purge removes the entire ' + \
                                'directory).  Defaults to {0}'.\
                                format(', '.join(SYSTEM_FILES)))
+    parser_common.add_argument('--max-file-size', '-m', action='store',
+                               dest='max_file_size', metavar='SIZE',
+                               default=parse_size(DEFAULT_MAX_FILE_SIZE),
+                               type=parse_size,
+                               help='Files larger than SIZE (such as ' + \
+                               '512K, 200M or 1G) are not archived.  ' + \
+                               '0 for no limit.  Defaults to {0}'.\
+                               format(DEFAULT_MAX_FILE_SIZE))
     parser_common.add_argument('--archive-directory', '-D', action='store',
                                dest='archive_directory', metavar='N',
                                default=ARCHIVE_DIRECTORY,
@@ -155,6 +343,44 @@ def parse_arguments():
                                help='Number of concurrent connections, ' + \
                                'set to 1 to serialize.  Defaults to ' + \
                                '{0}'.format(DEFAULT_WORKERS))
+    parser_common.add_argument('--shards', '-s', action='store',
+                               dest='shards', metavar='N',
+                               default=DEFAULT_SHARDS, type=int,
+                               help='Number of worker processes to split ' + \
+                               'hosts across with consistent hashing, ' + \
+                               'each with its own pool of ' + \
+                               '--parallel-workers connections.  ' + \
+                               'Defaults to {0}'.format(DEFAULT_SHARDS))
+    parser_common.add_argument('--shard-index', '-i', action='store',
+                               dest='shard_index', metavar='N',
+                               default=None, type=int,
+                               help='Only act on shard N of --shards, ' + \
+                               'numbered from 0.  Used to spread a run ' + \
+                               'across several control nodes, each ' + \
+                               'given the same hosts and --shards')
+    parser_common.add_argument('--progress', '-P', action='store_true',
+                               dest='progress', default=False,
+                               help='Show live progress on stderr: hosts ' + \
+                               'done, failed and pending, hosts/sec, ETA ' + \
+                               'and the slowest in-flight hosts.')
+    parser_common.add_argument('--progress-stream', action='store',
+                               dest='progress_stream', metavar='FILE',
+                               default=None,
+                               help='Write per-host progress events to ' + \
+                               'FILE as JSON lines, for use by wrapping ' + \
+                               'tools.')
+    parser_common.add_argument('--cache-file', action='store',
+                               dest='cache_file', metavar='FILE',
+                               default=CACHE_FILE,
+                               help='Archive metadata cached on this ' + \
+                               'machine, so report and latest dates ' + \
+                               'only list archives again on hosts ' + \
+                               'where they changed.  Defaults to ' + \
+                               '{0}'.format(CACHE_FILE))
+    parser_common.add_argument('--no-cache', action='store_true',
+                               dest='no_cache', default=False,
+                               help='Do not read or write the archive ' + \
+                               'metadata cache.')
     parser_common.add_argument('--sudo-password-prompt', '-p',
                                action='store_true', default=False,
                                dest='sudo_password_prompt',
@@ -169,15 +395,26 @@ def parse_arguments():
                                         'the current and most recent ' + \
                                         'archives are used by default')
     parser_diff.add_argument('--date-first', '-a', action='store',
-                             metavar='YYYYMMDD', dest='date_first', default=0,
-                             help="Date to perform comparison, defaults ' + \
-                             'to today's date, such as earlier today",
-                             type=int)
+                             metavar='YYYYMMDD|latest', dest='date_first',
+                             default=0, help='Date to perform ' + \
+                             "comparison, defaults to today's date, " + \
+                             'such as earlier today.  latest uses ' + \
+                             "each file's most recent archive",
+                             type=parse_date)
     parser_diff.add_argument('--date-second', '-b', action='store',
                              metavar='YYYYMMDD', dest='date_second',
                              default=1, help='Date to perform ' + \
                              'comparison, defaults to the live copy if ' + \
                              'unspecified', type=int)
+    parser_diff.add_argument('--max-diff-size', action='store',
+                             dest='max_diff_size', metavar='SIZE',
+                             default=parse_size(DEFAULT_MAX_DIFF_SIZE),
+                             type=parse_size,
+                             help='Files larger than SIZE, as well as ' + \
+                             'binary files, are compared by size and ' + \
+                             'checksum rather than diffed.  0 for no ' + \
+                             'limit.  Defaults to {0}'.\
+                             format(DEFAULT_MAX_DIFF_SIZE))
     subparsers.add_parser('purge', parents=[parser_common],
                           conflict_handler='resolve',
                           help='Purge all archived files')
@@ -188,11 +425,14 @@ def parse_arguments():
                                            'Defaults to today if a ' + \
                                            'YYYYMMDD date is not specified.')
     parser_recover.add_argument('--recover-date', '-r', action='store',
-                                metavar='YYYYMMDD', dest='recover_date',
-                                default=0, type=int, help='Date to ' + \
+                                metavar='YYYYMMDD|latest',
+                                dest='recover_date',
+                                default=0, type=parse_date,
+                                help='Date to ' + \
                                 'recover from if the file exists, ' + \
                                 "defaults to today's date, such as " + \
-                                'earlier today')
+                                'earlier today.  latest recovers ' + \
+                                "each file's most recent archive")
     parser_recover.add_argument('--post-recover-command', '-c',
                                 action='store', metavar='COMMAND',
                                 dest='post_recover_command',
@@ -202,10 +442,25 @@ def parse_arguments():
     parser_recover.add_argument('--dry-run', '-n', action='store_true',
                                 dest='dry_run', default=False,
                                 help="Don't actually recover files")
-    subparsers.add_parser('report', parents=[parser_common],
-                          conflict_handler='resolve',
-                          help='Summarized reporting of ' + \
-                          'archived system files')
+    parser_report = subparsers.add_parser('report', parents=[parser_common],
+                                          conflict_handler='resolve',
+                                          help='Summarized reporting of ' + \
+                                          'archived system files')
+    parser_report.add_argument('--shard-output', '-o', action='store',
+                               dest='shard_output', metavar='FILE',
+                               default=None,
+                               help='Also save the report as JSON to ' + \
+                               'FILE, to be combined with reports from ' + \
+                               'other control nodes by the merge ' + \
+                               'subcommand')
+    parser_merge = subparsers.add_parser('merge',
+                                         help='Combine reports saved ' + \
+                                         'with report --shard-output on ' + \
+                                         'several control nodes into a ' + \
+                                         'single report')
+    parser_merge.add_argument('shard_outputs', nargs='+', metavar='FILE',
+                              help='JSON report saved by report ' + \
+                              '--shard-output')
 
     # sphinx is not add_help=False aware...
     del subparsers.choices['common']
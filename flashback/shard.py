@@ -0,0 +1,168 @@
+# Copyright (C) 2015 zulily, llc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""flashback sharding"""
+from __future__ import print_function
+
+import bisect
+import hashlib
+import json
+import multiprocessing
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from fabric.api import env
+from fabric.colors import red, yellow
+from fabric.tasks import execute
+from fabric.network import disconnect_all
+
+# Number of points each shard is given on the hash ring, more points
+# spread hosts more evenly across shards
+DEFAULT_REPLICAS = 100
+# Seconds between checks that shard worker processes are still alive
+WORKER_POLL_INTERVAL = 1.0
+
+
+class HashRing(object):
+    """A consistent hash ring, mapping hosts onto shard numbers.  Adding
+    or removing a shard only moves the hosts that hashed to that shard.
+    """
+
+    def __init__(self, shard_count, replicas=DEFAULT_REPLICAS):
+        self.shard_count = shard_count
+        self._ring = dict()
+        for shard in range(shard_count):
+            for replica in range(replicas):
+                self._ring[self._hash('{0}-{1}'.format(shard, replica))] = shard
+        self._keys = sorted(self._ring)
+
+    @staticmethod
+    def _hash(key):
+        """Map a key to a position on the ring"""
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+
+    def get_shard(self, host):
+        """Return the shard number that host belongs to"""
+        index = bisect.bisect(self._keys, self._hash(host)) % len(self._keys)
+        return self._ring[self._keys[index]]
+
+
+def shard_hosts(hosts, shard_count):
+    """Split hosts into shard_count lists using consistent hashing.  The
+    order of hosts is preserved within each shard.
+    """
+    if shard_count <= 1:
+        return [list(hosts)]
+    ring = HashRing(shard_count)
+    shards = [list() for _ in range(shard_count)]
+    for host in hosts:
+        shards[ring.get_shard(host)].append(host)
+    return shards
+
+
+def _run_shard(queue, shard, hosts, task, args, kwargs):
+    """Worker process entry point, execute task against a single shard
+    of hosts and hand the per-host results back to the coordinator.
+    Tasks isolate failures per host, so a worker only exits without
+    reporting back if it is killed or hits an unexpected error.
+    """
+    env.hosts = hosts
+    try:
+        results = execute(task, *args, **kwargs)
+    finally:
+        disconnect_all()
+    queue.put((shard, results))
+
+
+def _fail_shard(results, hosts):
+    """Record every host in a shard whose worker died as failed, with no
+    result
+    """
+    env.setdefault('flashback_failed_hosts', list()).extend(hosts)
+    results.update((host, None) for host in hosts)
+
+
+def execute_sharded(shards, task, *args, **kwargs):
+    """Coordinator for sharded execution.  Each list of hosts in shards is
+    handed to its own worker process, which runs task with fabric's
+    execute.  Per-host results from every worker are merged into a single
+    dict, just as execute would return them.  Hosts in a shard whose worker
+    was killed, or exited without reporting back, have a result of None,
+    and are added to env.flashback_failed_hosts.
+    """
+    shards = [hosts for hosts in shards if hosts]
+    # With no hosts, fabric would run the task once locally
+    if not shards:
+        print(yellow('No hosts in this shard, {0} was not run'.\
+                     format(task.__name__)))
+        return dict()
+    if len(shards) == 1:
+        env.hosts = shards[0]
+        return execute(task, *args, **kwargs)
+
+    queue = multiprocessing.Queue()
+    # Workers fork their own fabric pools, so they must not be daemonic
+    workers = [multiprocessing.Process(target=_run_shard,
+                                       args=(queue, shard, hosts, task,
+                                             args, kwargs))
+               for shard, hosts in enumerate(shards)]
+    for worker in workers:
+        worker.start()
+    # Drain the queue before joining, or large results can deadlock
+    results = dict()
+    pending = dict(enumerate(shards))
+    while pending:
+        try:
+            shard, shard_results = queue.get(timeout=WORKER_POLL_INTERVAL)
+        except Empty:
+            # A worker killed by a signal never reports back
+            for shard in list(pending):
+                if workers[shard].exitcode not in (None, 0):
+                    print(red('[shard {0}] Worker exited with code {1}'.\
+                              format(shard, workers[shard].exitcode)))
+                    _fail_shard(results, pending.pop(shard))
+            continue
+        if shard in pending:
+            pending.pop(shard)
+            results.update(shard_results)
+    for worker in workers:
+        worker.join()
+
+    return results
+
+
+def write_shard_output(path, archive_data):
+    """Save one shard's report archive data as JSON, so reports from
+    several control nodes can be merged with merge_shard_outputs.
+    """
+    with open(path, 'w') as output_file:
+        json.dump(archive_data, output_file, indent=2, sort_keys=True)
+
+
+def merge_shard_outputs(paths):
+    """Merge report archive data saved by write_shard_output into a
+    single dict of host -> date -> archived files.
+    """
+    archive_data = dict()
+    for path in paths:
+        with open(path, 'r') as output_file:
+            for host, dates in json.load(output_file).items():
+                merged = archive_data.setdefault(host, dict())
+                for date, files in dates.items():
+                    merged_files = merged.setdefault(date, list())
+                    merged_files.extend(f for f in files
+                                        if f not in merged_files)
+    return archive_data
@@ -18,19 +18,84 @@ import os
 import re
 
 from datetime import datetime
-from fabric.api import env, sudo
+from fabric.api import env, settings, sudo
 from fabric.colors import green, red, yellow
 from jinja2 import Environment, PackageLoader
 
-def recover_files(system_files_map, recover_date, archive_directory, dry_run):
+# Number of leading bytes checked for NUL characters when deciding
+# whether a file is binary, the same heuristic git uses
+BINARY_CHECK_BYTES = 8000
+
+
+def compare_files(file_first, file_second, max_diff_size):
+    """Compare two remote files with a single command.  Returns one of:
+
+        ('missing', [paths that do not exist])
+        ('summary', {path: (size, sha256 checksum)}) for binary files,
+            or files larger than max_diff_size bytes (0 for no limit)
+        ('diff', diff -u output)
+
+    Checksums are streamed remotely, so only the digests cross the wire.
+    Raises IOError rather than letting fabric abort the host if the
+    command fails.
+    """
+    with settings(warn_only=True):
+        output = sudo('for path in {0} {1}; do test -e "$path" || '
+                      'echo "missing $path"; done | grep . && exit 0; '
+                      'check=diff; for path in {0} {1}; do '
+                      'if [ {2} -gt 0 ] && '
+                      '[ $(stat -L -c %s "$path") -gt {2} ] || '
+                      "[ $(head -c {3} \"$path\" | tr -d -c '\\000' | "
+                      'wc -c) -gt 0 ]; then check=summary; fi; done; '
+                      'echo $check; if [ $check = summary ]; then '
+                      'for path in {0} {1}; do '
+                      'echo $(stat -L -c %s "$path") $(sha256sum "$path"); '
+                      'done; else diff -u {0} {1}; fi; exit 0'.\
+                      format(file_first, file_second, max_diff_size or 0,
+                             BINARY_CHECK_BYTES))
+    lines = output.splitlines()
+    if output.failed or not lines:
+        raise IOError('Unable to compare {0} and {1}'.\
+                      format(file_first, file_second))
+    if lines[0].startswith('missing '):
+        return 'missing', [line.split(' ', 1)[1] for line in lines]
+    if lines[0] == 'summary':
+        summary = dict()
+        for line in lines[1:]:
+            size, checksum, path = line.split()
+            summary[path] = (int(size), checksum)
+        return 'summary', summary
+    return 'diff', '\n'.join(lines[1:])
+
+
+def recover_files(system_files_map, recover_date, archive_directory, dry_run,
+                  latest_dates=None):
     """For all hosts and specified system files, rollback
-    to the recover date that was specified.
+    to the recover date that was specified.  A recover date of 'latest'
+    uses each file's most recent archive date from latest_dates
+    (host -> file name -> date).  Hosts missing from latest_dates, whose
+    archives could not be checked, are not recovered.
     """
     if dry_run:
         print(yellow('File Recovery -- dry-run\n'))
     if recover_date == 0:
         recover_date = datetime.now().strftime('%Y%m%d')
+    recover_latest = recover_date == 'latest'
+    latest_dates = latest_dates or dict()
+    if recover_latest and env.host_string not in latest_dates:
+        env.flashback_error = True
+        print(red('[{0}] Unable to check archive dates, not recovering'.\
+                  format(env.host_string)))
+        return
+    latest = latest_dates.get(env.host_string, dict())
     for system_file in system_files_map:
+        if recover_latest:
+            recover_date = latest.get(system_file)
+            if recover_date is None:
+                env.flashback_error = True
+                print(red('[{0}] No archive found for file {1}'.\
+                          format(env.host_string, system_file)))
+                continue
         try:
             source_file = os.path.join(archive_directory,
                                        str(recover_date), system_file)
@@ -39,12 +104,13 @@ def recover_files(system_files_map, recover_date, archive_directory, dry_run):
                 format(env.host_string, recover_date, system_file,
                        system_files_map[system_file])))
             else:
-                sudo("cp -af {0} {1}".\
+                sudo("cp -af --reflink=auto {0} {1}".\
                      format(source_file, system_files_map[system_file]))
                 print(green('[{0}] Restored {1}/{2} -> {3}'.\
                 format(env.host_string, recover_date, system_file,
                        system_files_map[system_file])))
         except Exception:
+            env.flashback_error = True
             print(red('[{0}] Error rolling back file {1}/{2} -> {3}'.\
             format(env.host_string, recover_date, system_file,
                    system_files_map[system_file])))
@@ -64,18 +130,39 @@ def post_recover_command(command, dry_run):
             print(green('[{0}] Executed command: {1}'.\
                   format(env.host_string, command)))
         except:
+            env.flashback_error = True
             print(red('[{0}] Error executing command: {1}'.\
                       format(env.host_string, command)))
 
 
-def diff_files(system_files_map, date_first, date_second, archive_directory):
+def diff_files(system_files_map, date_first, date_second, archive_directory,
+               max_diff_size=0, latest_dates=None):
     """Going through the list of system_files specified, perform
     diffs against two dates.  If a version of the file is missing,
-    warn and continue.
+    warn and continue.  Binary files, or files larger than max_diff_size
+    bytes, are compared by size and checksum rather than with diff.  A
+    date_first of 'latest' uses each file's most recent archive date from
+    latest_dates (host -> file name -> date).  Hosts missing from
+    latest_dates, whose archives could not be checked, are not diffed.
     """
     today = datetime.now().strftime('%Y%m%d')
+    first_latest = date_first == 'latest'
+    latest_dates = latest_dates or dict()
+    if first_latest and env.host_string not in latest_dates:
+        env.flashback_error = True
+        print(red('[{0}] Unable to check archive dates, not diffing'.\
+                  format(env.host_string)))
+        return
+    latest = latest_dates.get(env.host_string, dict())
     try:
         for system_file in system_files_map:
+            if first_latest:
+                date_first = latest.get(system_file)
+                if date_first is None:
+                    env.flashback_error = True
+                    print(red('[{0}] No archive found for file {1}'.\
+                              format(env.host_string, system_file)))
+                    continue
             # If today's date is specfied for date_first, we will use
             # the archived version, if it exists
             if date_first == 0:
@@ -95,8 +182,34 @@ def diff_files(system_files_map, date_first, date_second, archive_directory):
             else:
                 file_second = os.path.join(archive_directory,
                                            str(date_second), system_file)
-            output = sudo("diff -u {0} {1} || exit 0".\
-                          format(file_first, file_second))
+            try:
+                result, output = compare_files(file_first, file_second,
+                                               max_diff_size)
+            except IOError as error:
+                env.flashback_error = True
+                print(red('[{0}] {1}'.format(env.host_string, error)))
+                continue
+            # A missing archive, such as a file skipped for its size,
+            # is warned about rather than ending this host's diffs
+            if result == 'missing':
+                env.flashback_error = True
+                print(yellow('[{0}] Missing archive for {1}: {2}'.\
+                             format(env.host_string, system_file,
+                                    ', '.join(output))))
+                continue
+            if result == 'summary':
+                if output[file_first][1] == output[file_second][1]:
+                    print(green('[{0}] No differences for {1}: {2} {3}'.\
+                          format(env.host_string, system_file,
+                                 str(date_first), str(date_second))))
+                else:
+                    print(yellow('[{0}] Binary or large files differ for '
+                                 '{1}:'.format(env.host_string, system_file)))
+                    for date, path in ((date_first, file_first),
+                                       (date_second, file_second)):
+                        print(yellow('    {0}: {1} bytes, sha256 {2}'.\
+                              format(date, *output[path])))
+                continue
             if len(output) == 0:
                 print(green('[{0}] No differences for {1}: {2} {3}'.\
                       format(env.host_string, system_file, str(date_first),
@@ -105,6 +218,7 @@ def diff_files(system_files_map, date_first, date_second, archive_directory):
                 print(yellow("[{0}]").format(env.host_string))
                 print(yellow(output.replace('[H', '')))
     except Exception:
+        env.flashback_error = True
         print(red('[{0}] Error running diff command'.\
                   format(env.host_string)))
         raise
@@ -146,31 +260,79 @@ def generate_report(archive_data):
     return template.render(data=archive_data)
 
 
-def find_archived_files(archive_directory):
-    """For all hosts, get a list of system files that are archived"""
+def find_archived_files(archive_directory, generations):
+    """For all hosts, get a list of system files that are archived.  Output
+    starts with a "generation DIRECTORY GENERATION" line, a checksum of the
+    archive directory's entries and their modification times.  The find is
+    skipped if the generation matches the one cached for this host in
+    generations (host -> archive directory -> generation).
+    """
     try:
-        return sudo("test -d {0} && find {0} -type f || exit 0".\
-                    format(archive_directory))
+        cached = generations.get(env.host_string, dict()).\
+            get(archive_directory, '')
+        return sudo("generation=$( (test -d {0} && find {0} -maxdepth 1 "
+                    "-printf '%f %T@\\n' | sort | md5sum) | cut -d' ' -f1); "
+                    "generation=${{generation:-none}}; "
+                    "echo generation {0} $generation; "
+                    "if [ \"$generation\" != \"{1}\" ]; then "
+                    "test -d {0} && find {0} -type f; fi; exit 0".\
+                    format(archive_directory, cached))
     except Exception:
+        env.flashback_error = True
         print(red('[{0}] Error running find command under directory {1}'.\
                   format(env.host_string, archive_directory)))
 
 
-def archive_files(system_files, archive_directory):
+def archive_files(system_files, archive_directory, size_limits=None):
     """Archive specified system files into archive_directory/YYYYMMDD/.  Only
-    copies if destination does not exist or is older than source
+    copies if destination does not exist or is older than source.  Files
+    larger than their limit in size_limits (full path -> bytes) are skipped.
+    A file identical to its most recent earlier archive is hard linked to
+    it rather than copied, otherwise copies are reflinked where the
+    filesystem supports it.
     """
-    destination_directory = os.path.join(archive_directory,
-                                         datetime.now().strftime('%Y%m%d'))
+    size_limits = size_limits or dict()
+    today = datetime.now().strftime('%Y%m%d')
+    destination_directory = os.path.join(archive_directory, today)
     sudo("mkdir -p {0}".format(destination_directory))
     for system_file in system_files:
-        full_path = os.path.join(destination_directory, system_file)
+        destination = os.path.join(destination_directory,
+                                   os.path.basename(system_file))
+        limit = size_limits.get(system_file) or 0
         try:
-            sudo("cp -up {0} {1}".format(full_path, destination_directory))
+            # The size check and copy run as a single command.  Replace
+            # rather than overwrite the destination, so earlier archives
+            # hard linked to it are left untouched.
+            with settings(warn_only=True):
+                output = sudo(
+                    'size=$(stat -L -c %s {3}) || exit 1; '
+                    'if [ {5} -gt 0 ] && [ $size -gt {5} ]; then '
+                    'echo skipped $size; exit 0; fi; '
+                    'previous=$(ls -1 {0}/[0-9]*/{1} 2>/dev/null | '
+                    'grep -v "^{2}/" | sort | tail -n 1); '
+                    'if [ -n "$previous" ] && cmp -s "$previous" {3} && '
+                    '[ "$(stat -c %a:%u:%g "$previous")" = '
+                    '"$(stat -L -c %a:%u:%g {3})" ]; '
+                    'then ln -f "$previous" {4}; '
+                    'else cp -up --reflink=auto --remove-destination {3} {4}; '
+                    'fi'.format(archive_directory,
+                                os.path.basename(system_file),
+                                destination_directory, system_file,
+                                destination, limit))
+            if output.failed:
+                raise IOError(output)
+            if output.startswith('skipped'):
+                print(yellow('[{0}] Skipped file {1}, {2} bytes exceeds '
+                             'the {3} byte limit'.\
+                             format(env.host_string, system_file,
+                                    output.split()[1], limit)))
+                continue
+            print(green('[{0}] Archived file {1}'.\
+                        format(env.host_string, system_file)))
         except Exception:
+            env.flashback_error = True
             print(red('[{0}] Error archiving file {1}'.\
                       format(env.host_string, system_file)))
-        print(green('[{0}] Archived file {1}'.format(env.host_string, system_file)))
 
 
 def purge(archive_directory):
@@ -180,6 +342,7 @@ def purge(archive_directory):
         print(green('[{0}] Purged directory {1}'.\
                     format(env.host_string, archive_directory)))
     except:
+        env.flashback_error = True
         print(red('[{0}] Error purging directory {1}'.\
                   format(env.host_string, archive_directory)))
 
@@ -25,9 +25,10 @@ setup(name='flashback',
                   'instances running sshd.',
       author='zulily, llc',
       author_email='opensource@zulily.com',
-      packages=find_packages(),
+      packages=find_packages(exclude=['tests']),
       url='https://github.com/zulily/flashback',
       license='Apache License, Version 2.0',
+      test_suite='tests',
       entry_points={
           'console_scripts': [
               'flashback = flashback.scripts.cli:main'
@@ -0,0 +1,249 @@
+# Copyright (C) 2015 zulily, llc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for flashback helpers that do not need an ssh connection"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from flashback.cache import ArchiveCache, parse_archive_output
+from flashback.inventory import Group, group_arguments, inventory_hosts, \
+                                read_inventory
+from flashback.scripts.cli import parse_size, parse_system_file
+from flashback.shard import merge_shard_outputs, shard_hosts, \
+                            write_shard_output
+
+HOSTS = ['host{0}.example.com'.format(i) for i in range(1000)]
+
+
+class TempDirectoryTestCase(unittest.TestCase):
+    """Provide a temporary directory, removed after each test"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        """Write content to a file in the temporary directory"""
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as output_file:
+            output_file.write(content)
+        return path
+
+
+class ShardTest(TempDirectoryTestCase):
+    """Consistent hashing of hosts, and merging shard output"""
+
+    def test_single_shard_keeps_all_hosts(self):
+        self.assertEqual(shard_hosts(HOSTS, 1), [HOSTS])
+
+    def test_every_host_in_exactly_one_shard(self):
+        shards = shard_hosts(HOSTS, 4)
+        self.assertEqual(sorted(sum(shards, [])), sorted(HOSTS))
+        for shard in shards:
+            self.assertTrue(shard)
+
+    def test_sharding_is_stable(self):
+        self.assertEqual(shard_hosts(HOSTS, 4), shard_hosts(HOSTS, 4))
+
+    def test_adding_a_shard_only_moves_hosts_to_it(self):
+        before = shard_hosts(HOSTS, 4)
+        after = shard_hosts(HOSTS, 5)
+        moved = [host for number, shard in enumerate(before)
+                 for host in shard if host not in after[number]]
+        # Moved hosts all land on the new shard, roughly 1/5 of them
+        self.assertEqual(sorted(moved), sorted(after[4]))
+        self.assertTrue(len(HOSTS) / 10 < len(moved) < len(HOSTS) * 2 / 5)
+
+    def test_merge_shard_outputs(self):
+        first = os.path.join(self.directory, 'first.json')
+        second = os.path.join(self.directory, 'second.json')
+        write_shard_output(first, {'a': {'20150101': ['passwd']}})
+        write_shard_output(second, {'a': {'20150101': ['passwd', 'group']},
+                                    'b': {}})
+        self.assertEqual(merge_shard_outputs([first, second]),
+                         {'a': {'20150101': ['passwd', 'group']}, 'b': {}})
+
+
+class SizeTest(unittest.TestCase):
+    """Parsing of --max-file-size and -F FULLPATH[:SIZE] arguments"""
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('0'), 0)
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('512K'), 512 * 1024)
+        self.assertEqual(parse_size('200m'), 200 * 1024 ** 2)
+        self.assertEqual(parse_size('1GB'), 1024 ** 3)
+
+    def test_parse_invalid_size(self):
+        self.assertRaises(argparse.ArgumentTypeError, parse_size, '1T')
+        self.assertRaises(argparse.ArgumentTypeError, parse_size, 'big')
+
+    def test_parse_system_file_with_size(self):
+        self.assertEqual(parse_system_file('/usr/share/GeoIP/GeoIP.dat:512M',
+                                           100),
+                         ('/usr/share/GeoIP/GeoIP.dat', 512 * 1024 ** 2))
+
+    def test_parse_system_file_without_size(self):
+        self.assertEqual(parse_system_file('/etc/passwd', 100),
+                         ('/etc/passwd', 100))
+
+    def test_parse_system_file_with_colon_in_path(self):
+        self.assertEqual(parse_system_file('/x:y', 100), ('/x:y', 100))
+
+
+class InventoryTest(TempDirectoryTestCase):
+    """Reading INI inventories and building per-host task arguments"""
+
+    def read(self, content, specs=('/etc/passwd',)):
+        """Read an inventory with the given content"""
+        inventory = self.write('inventory.ini', content)
+        return read_inventory(inventory,
+                              lambda spec: parse_system_file(spec, 100),
+                              list(specs), '/root/.flashback', None)
+
+    def test_groups(self):
+        self.write('db_hosts.txt', 'db1\ndb2\n\n')
+        web, db = self.read('[DEFAULT]\n'
+                            'archive_directory = /var/flashback\n'
+                            '[web]\n'
+                            'hosts = web1, web2 web3\n'
+                            'system_files = /etc/nginx/nginx.conf '
+                            '/etc/ssl/bundle.pem:1M\n'
+                            'post_recover_command = service nginx reload\n'
+                            '[db]\n'
+                            'hosts_file = db_hosts.txt\n')
+        self.assertEqual(web, Group('web', ['web1', 'web2', 'web3'],
+                                    ['/etc/nginx/nginx.conf',
+                                     '/etc/ssl/bundle.pem'],
+                                    {'/etc/nginx/nginx.conf': 100,
+                                     '/etc/ssl/bundle.pem': 1024 ** 2},
+                                    '/var/flashback',
+                                    'service nginx reload'))
+        self.assertEqual(db, Group('db', ['db1', 'db2'], ['/etc/passwd'],
+                                   {'/etc/passwd': 100}, '/var/flashback',
+                                   None))
+
+    def test_fallback_keeps_size_limits(self):
+        group, = self.read('[web]\nhosts = web1\n',
+                           specs=['/usr/share/GeoIP/GeoIP.dat:512M'])
+        self.assertEqual(group.size_limits,
+                         {'/usr/share/GeoIP/GeoIP.dat': 512 * 1024 ** 2})
+
+    def test_group_without_hosts(self):
+        self.assertRaises(ValueError, self.read, '[web]\n')
+
+    def test_missing_inventory(self):
+        self.assertRaises(ValueError, read_inventory,
+                          os.path.join(self.directory, 'missing.ini'),
+                          None, [], '/root/.flashback', None)
+
+    def test_hosts_and_arguments(self):
+        groups = [Group('web', ['web1', 'both'], [], {}, '/a', None),
+                  Group('db', ['both', 'db1'], [], {}, '/a', 'restart'),
+                  Group('log', ['both'], [], {}, '/b', None)]
+        self.assertEqual(inventory_hosts(groups), ['web1', 'both', 'db1'])
+        arguments = group_arguments(
+            groups, lambda group: (group.archive_directory,))
+        # Identical arguments from several groups run once per host
+        self.assertEqual(dict(arguments), {'web1': [('/a',)],
+                                           'both': [('/a',), ('/b',)],
+                                           'db1': [('/a',)]})
+        arguments = group_arguments(
+            groups, lambda group: (group.post_recover_command,)
+            if group.post_recover_command else None)
+        self.assertEqual(dict(arguments), {'both': [('restart',)],
+                                           'db1': [('restart',)]})
+
+
+class CacheTest(TempDirectoryTestCase):
+    """Caching of archive metadata between runs"""
+
+    LISTING = ('generation /root/.flashback abc\n'
+               '/root/.flashback/20150101/passwd\n'
+               '/root/.flashback/20150102/passwd\n'
+               '/root/.flashback/20150102/group\n')
+
+    def test_parse_archive_output(self):
+        self.assertEqual(parse_archive_output(
+            'generation /a 1\n/a/20150101/passwd\ngeneration /b 2\n'),
+                         [('/a', '1', ['/a/20150101/passwd']),
+                          ('/b', '2', [])])
+
+    def test_update(self):
+        cache = ArchiveCache()
+        cache.update({'a': self.LISTING, 'b': None})
+        self.assertEqual(cache.generations(), {'a': {'/root/.flashback':
+                                                     'abc'}})
+        self.assertEqual(cache.archive_data(['a'],
+                                            {'a': ['/root/.flashback']}),
+                         {'a': {'20150101': ['passwd'],
+                                '20150102': ['passwd', 'group']}})
+
+    def test_unchanged_generation_skips_relisting(self):
+        cache = ArchiveCache()
+        cache.update({'a': self.LISTING})
+        # The remote find is skipped, so no paths follow the generation
+        cache.update({'a': 'generation /root/.flashback abc\n'})
+        self.assertEqual(cache.archive_data(['a'],
+                                            {'a': ['/root/.flashback']}),
+                         {'a': {'20150101': ['passwd'],
+                                '20150102': ['passwd', 'group']}})
+
+    def test_changed_generation_relists(self):
+        cache = ArchiveCache()
+        cache.update({'a': self.LISTING})
+        cache.update({'a': 'generation /root/.flashback def\n'
+                           '/root/.flashback/20150103/shadow\n'})
+        self.assertEqual(cache.archive_data(['a'],
+                                            {'a': ['/root/.flashback']}),
+                         {'a': {'20150103': ['shadow']}})
+
+    def test_failed_host_left_as_is(self):
+        cache = ArchiveCache()
+        cache.update({'a': self.LISTING})
+        cache.update({'a': None})
+        self.assertEqual(cache.generations(), {'a': {'/root/.flashback':
+                                                     'abc'}})
+
+    def test_latest_dates(self):
+        cache = ArchiveCache()
+        cache.update({'a': self.LISTING, 'b': self.LISTING})
+        # Only the given hosts are included, with empty dates for hosts
+        # that have no archives
+        self.assertEqual(cache.latest_dates('/root/.flashback', ['a', 'c']),
+                         {'a': {'passwd': 20150102, 'group': 20150102},
+                          'c': {}})
+
+    def test_save_and_load(self):
+        path = os.path.join(self.directory, 'cache.json')
+        cache = ArchiveCache(path)
+        cache.update({'a': self.LISTING})
+        cache.save()
+        self.assertEqual(ArchiveCache(path).hosts, cache.hosts)
+        with open(path, 'r') as cache_file:
+            self.assertEqual(json.load(cache_file), cache.hosts)
+
+    def test_corrupt_cache_is_ignored(self):
+        self.assertEqual(ArchiveCache(self.write('cache.json', '{')).hosts,
+                         dict())
+
+
+if __name__ == '__main__':
+    unittest.main()